@@ -1,6 +1,10 @@
-from itertools import combinations
-from math import comb
-from random import sample, shuffle
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from functools import lru_cache, partial
+from itertools import chain, combinations
+from multiprocessing import Pool
+from random import Random
+import sys
 from termcolor import colored
 
 
@@ -12,10 +16,20 @@ holding_size = 4
 num_players = 6
 
 
+# Parallelism
+num_processes = None # None runs one process per CPU core
+trials_per_task = 100 # trials handed to a process at a time
+
+
+# Output
+trial_lines_per_write = 1000 # trial lines are buffered and written to stdout in chunks of this many
+
+
 # Constants computed based on parameters
 num_couplets_per_holding = int(holding_size * (holding_size - 1) / 2)
 num_opponents = num_players - 1
 num_opponents_couplets = num_opponents * num_couplets_per_holding
+deck_size = num_ranks * num_suits
 
 
 # Non-adjustable constants
@@ -38,48 +52,67 @@ spades = 2
 diamonds = 1
 clubs = 0
 anything = 999
+card_bits = [1 << card for card in range(deck_size)]
+card_pair_bits = [(card_bits[card_1], card_bits[card_2]) for card_1, card_2 in combinations(range(deck_size), 2)] # every possible couplet
+holding_pair_indices = list(combinations(range(holding_size), 2)) # positions within a holding of each of its couplets
+nibble_ones = sum(1 << (rank * 4) for rank in range(num_ranks)) # rank tallies are packed 4 bits per rank, so num_suits must not exceed 7
+
 
+# A card is an int encoding its rank and suit as rank * num_suits + suit, and a set of cards (a board or a holding) is a
+# bitboard: an int with one bit set per card. A specific couplet is the bitboard of its two cards, while a generic
+# couplet is the tuple (rank_1, suit_1, rank_2, suit_2), any element of which may be "anything".
+def make_card(rank, suit):
+    return rank * num_suits + suit
 
-class Card:
 
-    def __init__(self, rank, suit):
-        self.rank = rank
-        self.suit = suit
+def card_rank(card):
+    return card // num_suits
 
-    def is_copy(self, target_card):
-        return self.rank == target_card.rank and self.suit == target_card.suit
 
-    def fulfills(self, target_card):
-        rank_fulfills = target_card.rank == anything or self.rank == target_card.rank
-        suit_fulfills = target_card.suit == anything or self.suit == target_card.suit
-        return rank_fulfills and suit_fulfills
+def card_suit(card):
+    return card % num_suits
 
-    def is_compatible(self, board):
-        for target_card in board:
-            if self.is_copy(target_card):
-                return False
-        return True
 
-    def str(self):
-        return rank_to_str(self.rank) + suit_to_str(self.suit)
+def is_compatible(card, board_bb):
+    return not card_bits[card] & board_bb
 
 
-class Couplet: # a couplet is two cards that form a subset of a player's holding
+def card_to_str(card):
+    return card_strs[card]
+
+
+def bitboard(cards):
+    cards_bb = 0
+    for card in cards:
+        cards_bb |= card_bits[card]
+    return cards_bb
+
 
-    def __init__(self, card_1, card_2):
-        self.card_1 = card_1
-        self.card_2 = card_2
+def generic_couplet_is_compatible(generic_couplet, board_bb): # cards with an "anything" rank or suit never copy a board card
+    rank_1, suit_1, rank_2, suit_2 = generic_couplet
+    return (anything in (rank_1, suit_1) or is_compatible(make_card(rank_1, suit_1), board_bb)) and \
+           (anything in (rank_2, suit_2) or is_compatible(make_card(rank_2, suit_2), board_bb))
 
-    def fulfills(self, target_couplet):
-        fulfills_in_order = self.card_1.fulfills(target_couplet.card_1) and self.card_2.fulfills(target_couplet.card_2)
-        fulfills_out_of_order = self.card_1.fulfills(target_couplet.card_2) and self.card_2.fulfills(target_couplet.card_1)
-        return fulfills_in_order or fulfills_out_of_order
 
-    def is_compatible(self, board):
-        return self.card_1.is_compatible(board) and self.card_2.is_compatible(board)
+@lru_cache(maxsize=None)
+def fulfilling_cards_bb(rank, suit): # bitboard of every card that fulfills the given rank and suit, either of which may be "anything"
+    return bitboard([card for card in range(deck_size) \
+                     if (rank == anything or card_rank(card) == rank) and (suit == anything or card_suit(card) == suit)])
 
-    def str(self):
-        return self.card_1.str() + " " + self.card_2.str()
+
+# Flatten generic levels into a table of (level index, cards fulfilling the first card, cards fulfilling the second card),
+# so that testing whether a specific couplet fulfills a generic couplet takes a few ANDs
+def compile_generic_levels(generic_levels):
+    return [(level_index, fulfilling_cards_bb(rank_1, suit_1), fulfilling_cards_bb(rank_2, suit_2)) \
+            for level_index in range(len(generic_levels)) \
+            for rank_1, suit_1, rank_2, suit_2 in generic_levels[level_index]]
+
+
+def couplet_to_str(couplet):
+    if isinstance(couplet, tuple): # generic couplet
+        rank_1, suit_1, rank_2, suit_2 = couplet
+        return rank_to_str(rank_1) + suit_to_str(suit_1) + " " + rank_to_str(rank_2) + suit_to_str(suit_2)
+    return card_to_str((couplet & -couplet).bit_length() - 1) + " " + card_to_str(couplet.bit_length() - 1) # lowest and highest set bits
 
 
 def rank_to_str(rank):
@@ -112,6 +145,9 @@ def suit_to_str(suit):
         return colored("\u00D7", "yellow")
 
 
+card_strs = [rank_to_str(card_rank(card)) + suit_to_str(card_suit(card)) for card in range(deck_size)]
+
+
 def rank_range():
     return reversed(range(num_ranks))
 
@@ -121,229 +157,250 @@ def suit_range():
 
 
 def assemble_deck():
-    deck = []
-    for rank in rank_range(): # reversing ensures that higher-ranked cards are assessed first
-        for suit in suit_range():
-            deck.append(Card(rank, suit))
-    return deck
+    return list(range(deck_size))
 
 
-def deal_random_cards(num_cards, deck):
-    shuffle(deck)
-    return sample(deck, num_cards)
+def deal_random_cards(num_cards, deck, rng): # sample already draws uniformly without replacement, so no shuffle is needed
+    return rng.sample(deck, num_cards)
 
 
-def print_cards(cards, label=""):
+def cards_to_str(cards, label=""):
     cards_str = label
     for card in cards:
-        cards_str += card.str() + " "
-    print(cards_str)
+        cards_str += card_to_str(card) + " "
+    return cards_str
+
+
+def print_cards(cards, label=""):
+    print(cards_to_str(cards, label))
+
+
+def write_lines(lines):
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 def partition_by_suit(board):
-    return [[card for card in board if card.suit == suit] \
+    return [[card for card in board if card_suit(card) == suit] \
             for suit in suit_range()]
 
 
-def extract_ranks(board, include_deprecation):
-    board_ranks = [card.rank for card in board]
-    if include_deprecation:
-        board_ranks += [deprecated_ace for rank in board_ranks if rank == ace]
-    return board_ranks
+def extract_ranks(board):
+    return [card_rank(card) for card in board]
+
+
+# Mask with bit rank + 1 set for each given rank, and bit 0 set for a deprecated Ace, so that the ranks of every straight
+# occupy five consecutive bits
+def straight_rank_mask(board_ranks):
+    rank_mask = 0
+    for rank in board_ranks:
+        rank_mask |= 1 << (rank + 1)
+    if rank_mask & (1 << (ace + 1)):
+        rank_mask |= 1 << (deprecated_ace + 1)
+    return rank_mask
+
+
+def mask_rank(rank_bit): # inverse of straight_rank_mask for a single bit
+    return rank_bit.bit_length() - 2
+
+
+def set_bits(mask):
+    bits = []
+    while mask:
+        bits.append(mask & -mask)
+        mask &= mask - 1
+    return bits
 
 
-def tally_ranks(board):
-    board_ranks = extract_ranks(board, False)
-    rank_tallies = {rank: 0 for rank in rank_range()}
+def tally_ranks(board_ranks): # the tally of each rank occupies the 4 bits starting at bit rank * 4
+    rank_tallies = 0
     for board_rank in board_ranks:
-        rank_tallies[board_rank] += 1
+        rank_tallies += 1 << (board_rank * 4)
     return rank_tallies
 
 
+def tally_of(rank_tallies, rank):
+    return (rank_tallies >> (rank * 4)) & 0xF
+
+
+# Mask with the top bit of each rank's nibble set if that rank's tally is at least min_tally; adding 8 - min_tally to a
+# tally of at most 7 sets its top bit exactly when the tally reaches min_tally, and never carries into the next nibble
+def tallies_reaching(rank_tallies, min_tally):
+    return (rank_tallies + (8 - min_tally) * nibble_ones) & (8 * nibble_ones)
+
+
 def max_tally(rank_tallies): # used for determining whether the board is paired, tripled, etc.
-    most_of_one_rank = 0
-    for rank in rank_range():
-        rank_tally = rank_tallies[rank]
-        if rank_tally > most_of_one_rank:
-            most_of_one_rank = rank_tally
-    return most_of_one_rank
+    for most_of_one_rank in reversed(range(1, num_suits + 1)):
+        if tallies_reaching(rank_tallies, most_of_one_rank):
+            return most_of_one_rank
+    return 0
 
 
 def highest_repeated_rank(rank_tallies):
-    for rank in rank_range():
-        rank_tally = rank_tallies[rank]
-        if rank_tally > 1:
-            return rank
+    repeated_ranks_mask = tallies_reaching(rank_tallies, 2)
+    if repeated_ranks_mask:
+        return (repeated_ranks_mask.bit_length() - 1) // 4
     return None # should never get this far as long as function is called only when board is paired
 
 
 # Construct a couplet whose cards share the given rank
 def pair_couplet(rank):
-    return Couplet(Card(rank, anything), Card(rank, anything))
-
-
-# Convert the (first) two cards in a list-of-cards into a couplet
-def couplify(cards):
-    return Couplet(cards[0], cards[1])
+    return (rank, anything, rank, anything)
 
 
 # Convert the (first) two ranks in a list-of-ranks into a couplet
 def couplify_ranks(ranks, suit):
-    return Couplet(Card(ranks[0] % num_ranks, suit), Card(ranks[1] % num_ranks, suit)) # modulo undeprecates any Aces
+    return (ranks[0] % num_ranks, suit, ranks[1] % num_ranks, suit) # modulo undeprecates any Aces
 
 
-def remove_incompatible_couplets(level, forbidden_cards):
-    return [couplet for couplet in level if couplet.is_compatible(forbidden_cards)]
+def subsets_of_size(n, zet):
+    return list(combinations(zet, n))
 
 
-def index_of_level_containing(target_couplet, levels):
-    for level_index in range(len(levels)):
-        level = levels[level_index]
-        for couplet in level:
-            if target_couplet.fulfills(couplet):
-                return level_index
-    return None # should never get here given how/where this function is used in this program
+def flatten(lizt):
+    return list(chain.from_iterable(lizt))
 
 
-def subsets_of_size(n, zet):
-    return list(combinations(zet, n))
+# Binomial coefficients comb(n, k) for all n up to max_n and k up to max_k, built row by row from Pascal's rule
+def pascal_triangle(max_n, max_k):
+    triangle = [[1] + [0] * max_k]
+    for n in range(max_n):
+        previous_row = triangle[-1]
+        triangle.append([1] + [previous_row[k - 1] + previous_row[k] for k in range(1, max_k + 1)])
+    return triangle
 
 
-def flatten(lizt):
-    flat_list = []
-    for sublist in lizt:
-        flat_list += sublist
-    return flat_list
+comb_table = pascal_triangle(len(card_pair_bits) + 1, num_opponents_couplets + 1) # no couplet count exceeds the number of possible couplets
 
 
 def all_levels(board): # a level is a list of 1 or more couplets that, given the board cards, form a hand of equal value
-    return straight_flush_levels(board) + \
-           four_of_a_kind_levels(board) + \
-           full_house_levels(board) + \
-           flush_levels(board) + \
-           straight_levels(board) + \
-           three_of_a_kind_levels(board) + \
-           two_pair_levels(board) + \
-           one_pair_levels(board) + \
-           high_card_levels(board) + \
-           [[Couplet(Card(anything, anything), Card(anything, anything))]] # emergency catch-all; all possible holdings should qualify for a level above this line
-
-
-def straight_flush_levels(board): # for boards longer than 5 cards, this function is sensitive to the relative "highness" of the suits
+    board_ranks = extract_ranks(board)
+    suited_ranks = [(card_suit(subboard[0]), extract_ranks(subboard)) \
+                    for subboard in partition_by_suit(board) \
+                    if len(subboard) >= 3] # only suits with 3 or more board cards can make a flush
+    rank_tallies = tally_ranks(board_ranks) # tallied once here rather than by each function below
+    most_of_one_rank = max_tally(rank_tallies)
+    signature = BoardSignature(board_ranks, suited_ranks, rank_tallies, most_of_one_rank)
+    category_functions = category_functions_by_max_tally[min(most_of_one_rank, 3)]
+    return flatten([category_levels(signature) for category_levels in category_functions]) + \
+           [[(anything, anything, anything, anything)]] # emergency catch-all; all possible holdings should qualify for a level above this line
+
+
+# Everything the category functions below need to know about a board
+BoardSignature = namedtuple('BoardSignature', 'ranks suited_ranks rank_tallies most_of_one_rank')
+
+
+def straight_flush_levels(signature): # for boards longer than 5 cards, this function is sensitive to the relative "highness" of the suits
     levels = []
-    for subboard in partition_by_suit(board):
-        if len(subboard) >= 3:
-            subboard_suit = subboard[0].suit
-            levels += straight_levels_with_suit(subboard, subboard_suit)
+    board_bb = 0 # only board cards of the flushable suits can clash with a straight flush couplet
+    for subboard_suit, subboard_ranks in signature.suited_ranks:
+        board_bb |= bitboard([make_card(rank, subboard_suit) for rank in subboard_ranks])
+        levels += straight_levels_with_suit(subboard_ranks, subboard_suit)
     '''return levels''' # version that allows duplicate cards
-    return remove_empty_levels([remove_incompatible_couplets(inner_level, board) \
+    return remove_empty_levels([[couplet for couplet in inner_level if generic_couplet_is_compatible(couplet, board_bb)] \
                                 for inner_level in levels]) # version that assumes no duplicate cards
 
 
-def four_of_a_kind_levels(board):
+def four_of_a_kind_levels(signature):
     levels = []
-    rank_tallies = tally_ranks(board)
+    rank_tallies = signature.rank_tallies
     for rank in rank_range():
-        rank_tally = rank_tallies[rank]
+        rank_tally = tally_of(rank_tallies, rank)
         if rank_tally == 2:
             levels.append([pair_couplet(rank)])
         elif rank_tally >= 3:
-            levels.append([Couplet(Card(rank, anything), Card(anything, anything))])
+            levels.append([(rank, anything, anything, anything)])
     return levels
 
 
-def full_house_levels(board):
+def full_house_levels(signature):
     levels = []
-    rank_tallies = tally_ranks(board)
-    most_of_one_rank = max_tally(rank_tallies)
+    rank_tallies = signature.rank_tallies
+    most_of_one_rank = signature.most_of_one_rank
     if most_of_one_rank == 2:
         for rank in rank_range(): # first check for all the ways to make Aces full, then Kings full, Queens full, etc.
-            rank_tally = rank_tallies[rank]
+            rank_tally = tally_of(rank_tallies, rank)
             if rank_tally == 1:
                 levels.append([pair_couplet(rank)])
             elif rank_tally == 2:
-                [levels.append([Couplet(Card(rank, anything), Card(inner_rank, anything))]) \
-                 for inner_rank in rank_range() \
-                 if (rank_tallies[inner_rank] == 1) or (rank_tallies[inner_rank] == 2 and inner_rank < rank)]
+                levels.extend([(rank, anything, inner_rank, anything)] \
+                              for inner_rank in rank_range() \
+                              if (tally_of(rank_tallies, inner_rank) == 1) or (tally_of(rank_tallies, inner_rank) == 2 and inner_rank < rank))
                 # the second condition ensures that, on a double-paired board, a couplet matching both pairs counts as high-full-of-low rather than low-full-of-high
     elif most_of_one_rank >= 3:
         continue_scan = True
         for rank in rank_range():
             if continue_scan:
-                rank_tally = rank_tallies[rank]
+                rank_tally = tally_of(rank_tallies, rank)
                 if rank_tally == 1:
                     levels.append([pair_couplet(rank)])
                 elif rank_tally >= 3: # the rank tally of 2 can be skipped, since it always makes quads rather than a full house
-                    [levels.append([pair_couplet(inner_rank)]) \
-                     for inner_rank in rank_range() \
-                     if (rank_tallies[inner_rank] == 0) or (rank_tallies[inner_rank] == 1 and inner_rank < rank)]
+                    levels.extend([pair_couplet(inner_rank)] \
+                                  for inner_rank in rank_range() \
+                                  if (tally_of(rank_tallies, inner_rank) == 0) or (tally_of(rank_tallies, inner_rank) == 1 and inner_rank < rank))
                     continue_scan = False # all pocket pairs lower than the board triple are assessed in this iteration and therefore do not need to appear in a future full house level
     return levels # skips all of the above steps and returns no levels if board is not at least paired
 
 
-def flush_levels(board): # for boards longer than 5 cards, this function is sensitive to the relative "highness" of the suits
+def flush_levels(signature): # for boards longer than 5 cards, this function is sensitive to the relative "highness" of the suits
     levels = []
-    for subboard in partition_by_suit(board):
-        if len(subboard) >= 3:
-            subboard_suit = subboard[0].suit
-            '''[levels.append([Couplet(Card(rank, subboard_suit), Card(anything, subboard_suit))]) \
-             for rank in rank_range()]''' # version that allows duplicate cards in deck
-            for novel_rank in [rank \
-                               for rank in reversed(range(three, num_ranks)) \
-                               if rank not in extract_ranks(subboard, False)]: # no suited couplet is lower than Three-high; also, this line assumes no card appears more than once in the deck
-                levels.append([Couplet(Card(novel_rank, subboard_suit), Card(anything, subboard_suit))]) # version that disallows duplicate cards in deck
+    for subboard_suit, subboard_ranks in signature.suited_ranks:
+        '''levels.extend([(rank, subboard_suit, anything, subboard_suit)] \
+                      for rank in rank_range())''' # version that allows duplicate cards in deck
+        for novel_rank in [rank \
+                           for rank in reversed(range(three, num_ranks)) \
+                           if rank not in subboard_ranks]: # no suited couplet is lower than Three-high; also, this line assumes no card appears more than once in the deck
+            levels.append([(novel_rank, subboard_suit, anything, subboard_suit)]) # version that disallows duplicate cards in deck
     return levels
 
 
-def straight_levels(board):
-    return straight_levels_with_suit(board, anything)
+def straight_levels(signature):
+    return straight_levels_with_suit(signature.ranks, anything)
 
 
-def straight_levels_with_suit(board, suit_to_record): # may output the same couplet in multiple levels, but this is OK
+def straight_levels_with_suit(board_ranks, suit_to_record): # may output the same couplet in multiple levels, but this is OK
     levels = []
-    unique_board_ranks = []
-    [unique_board_ranks.append(rank) for rank in extract_ranks(board, True) if rank not in unique_board_ranks]
+    board_rank_mask = straight_rank_mask(board_ranks)
     for rank in reversed(range(five, num_ranks)): # when allowing exactly 1 rank (Ace) to be deprecated, a Five-high straight is the lowest possible straight
-        levels.append(straight_level_with_suit(rank, unique_board_ranks, suit_to_record))
+        levels.append(straight_level_with_suit(rank, board_rank_mask, suit_to_record))
     return remove_empty_levels(levels)
 
 
 # List all couplets which form a [high_rank]-high straight given the board
-def straight_level_with_suit(high_rank, board_ranks, suit_to_record):
-    straight_ranks = [rank for rank in reversed(range(high_rank - 4, high_rank + 1))] # list all ranks which make up a [high_rank]-high straight, in descending order
-    return [couplify_ranks([rank \
-                            for rank in straight_ranks \
-                            if rank not in subset], suit_to_record) \
-            for subset in subsets_of_size(3, sorted(board_ranks, reverse=True)) \
-            if subset in subsets_of_size(3, straight_ranks)]
+def straight_level_with_suit(high_rank, board_rank_mask, suit_to_record):
+    straight_mask = 0b11111 << (high_rank - 3) # mask of all ranks which make up a [high_rank]-high straight
+    level = []
+    for subset in subsets_of_size(3, set_bits(straight_mask & board_rank_mask)): # any 3 board ranks within the straight
+        missing_mask = straight_mask & ~(subset[0] | subset[1] | subset[2]) # the 2 straight ranks the couplet must supply
+        level.append(couplify_ranks([mask_rank(missing_mask), mask_rank(missing_mask & -missing_mask)], suit_to_record))
+    return level
 
 
-def three_of_a_kind_levels(board):
+def three_of_a_kind_levels(signature):
     levels = []
-    rank_tallies = tally_ranks(board)
-    most_of_one_rank = max_tally(rank_tallies)
+    rank_tallies = signature.rank_tallies
+    most_of_one_rank = signature.most_of_one_rank
     if most_of_one_rank == 1:
         for rank in rank_range():
-            rank_tally = rank_tallies[rank]
+            rank_tally = tally_of(rank_tallies, rank)
             if rank_tally == 1:
                 levels.append([pair_couplet(rank)])
     elif most_of_one_rank == 2:
         for rank in rank_range():
-            rank_tally = rank_tallies[rank]
+            rank_tally = tally_of(rank_tallies, rank)
             if rank_tally == 2:
-                [levels.append([Couplet(Card(rank, anything), Card(inner_rank, anything))]) \
-                 for inner_rank in rank_range() \
-                 if rank_tallies[inner_rank] == 0]
+                levels.extend([(rank, anything, inner_rank, anything)] \
+                              for inner_rank in rank_range() \
+                              if tally_of(rank_tallies, inner_rank) == 0)
     elif most_of_one_rank >= 3:
         continue_scan = True
         tally_2_overranks = [] # will soon contain the rank of all board pairs higher than the highest board trips
         for rank in rank_range(): # check for trip Aces first, then trip Kings, Queens, etc.
             if continue_scan:
-                rank_tally = rank_tallies[rank]
+                rank_tally = tally_of(rank_tallies, rank)
                 if rank_tally == 2: # can skip rank tally of 1 because it always makes a full house rather than trips
-                    [levels.append([Couplet(Card(rank, anything), Card(inner_rank, anything))]) \
-                     for inner_rank in rank_range() \
-                     if rank_tallies[inner_rank] == 0]
+                    levels.extend([(rank, anything, inner_rank, anything)] \
+                                  for inner_rank in rank_range() \
+                                  if tally_of(rank_tallies, inner_rank) == 0)
                     tally_2_overranks.append(rank)
                 elif rank_tally == 3:
                     higher_kicker_rank_range = [inner_rank \
@@ -354,77 +411,88 @@ def three_of_a_kind_levels(board):
                                                    for inner_rank in higher_kicker_rank_range \
                                                    if inner_rank < higher_kicker_rank]
                         for lower_kicker_rank in lower_kicker_rank_range:
-                            levels.append([Couplet(Card(higher_kicker_rank, anything), Card(lower_kicker_rank, anything))])
+                            levels.append([(higher_kicker_rank, anything, lower_kicker_rank, anything)])
                     continue_scan = False
     return levels
 
 
-def two_pair_levels(board):
+def two_pair_levels(signature):
     levels = []
-    rank_tallies = tally_ranks(board)
-    most_of_one_rank = max_tally(rank_tallies)
+    rank_tallies = signature.rank_tallies
+    most_of_one_rank = signature.most_of_one_rank
     if most_of_one_rank == 1:
-        higher_pair_rank_range = [rank for rank in rank_range() if rank_tallies[rank] == 1]
+        higher_pair_rank_range = [rank for rank in rank_range() if tally_of(rank_tallies, rank) == 1]
         for higher_pair_rank in higher_pair_rank_range:
             lower_pair_rank_range = [rank for rank in higher_pair_rank_range if rank < higher_pair_rank]
             for lower_pair_rank in lower_pair_rank_range:
-                levels.append([Couplet(Card(higher_pair_rank, anything), Card(lower_pair_rank, anything))])
+                levels.append([(higher_pair_rank, anything, lower_pair_rank, anything)])
     elif most_of_one_rank == 2:
         board_pair_rank = highest_repeated_rank(rank_tallies)
         for rank in rank_range():
-            rank_tally = rank_tallies[rank]
+            rank_tally = tally_of(rank_tallies, rank)
             if rank_tally == 0:
                 levels.append([pair_couplet(rank)])
             if rank_tally == 1:
-                [levels.append([Couplet(Card(rank, anything), Card(inner_rank, anything))]) \
-                 for inner_rank in rank_range() \
-                 if inner_rank > board_pair_rank and rank_tallies[inner_rank] == 1 and inner_rank != rank]
-                [levels.append([Couplet(Card(rank, anything), Card(inner_rank, anything))]) \
-                 for inner_rank in rank_range() \
-                 if inner_rank < board_pair_rank or rank_tallies[inner_rank] == 0]
+                levels.extend([(rank, anything, inner_rank, anything)] \
+                              for inner_rank in rank_range() \
+                              if inner_rank > board_pair_rank and tally_of(rank_tallies, inner_rank) == 1 and inner_rank != rank)
+                levels.extend([(rank, anything, inner_rank, anything)] \
+                              for inner_rank in rank_range() \
+                              if inner_rank < board_pair_rank or tally_of(rank_tallies, inner_rank) == 0)
     return levels
 
 
-def one_pair_levels(board):
+def one_pair_levels(signature):
     levels = []
-    rank_tallies = tally_ranks(board)
-    most_of_one_rank = max_tally(rank_tallies)
+    rank_tallies = signature.rank_tallies
+    most_of_one_rank = signature.most_of_one_rank
     if most_of_one_rank == 1:
         for rank in rank_range():
-            rank_tally = rank_tallies[rank]
+            rank_tally = tally_of(rank_tallies, rank)
             if rank_tally == 0:
                 levels.append([pair_couplet(rank)])
             if rank_tally == 1:
-                [levels.append([Couplet(Card(rank, anything), Card(inner_rank, anything))]) \
-                 for inner_rank in rank_range() \
-                 if rank_tallies[inner_rank] == 0]
+                levels.extend([(rank, anything, inner_rank, anything)] \
+                              for inner_rank in rank_range() \
+                              if tally_of(rank_tallies, inner_rank) == 0)
     elif most_of_one_rank == 2:
-        higher_kicker_rank_range = [rank for rank in rank_range() if rank_tallies[rank] == 0]
+        higher_kicker_rank_range = [rank for rank in rank_range() if tally_of(rank_tallies, rank) == 0]
         for higher_kicker_rank in higher_kicker_rank_range:
             lower_kicker_rank_range = [rank for rank in higher_kicker_rank_range if rank < higher_kicker_rank]
             for lower_kicker_rank in lower_kicker_rank_range:
-                levels.append([Couplet(Card(higher_kicker_rank, anything), Card(lower_kicker_rank, anything))])
+                levels.append([(higher_kicker_rank, anything, lower_kicker_rank, anything)])
     return levels
 
 
-def high_card_levels(board):
+def high_card_levels(signature):
     levels = []
-    rank_tallies = tally_ranks(board)
-    most_of_one_rank = max_tally(rank_tallies)
+    rank_tallies = signature.rank_tallies
+    most_of_one_rank = signature.most_of_one_rank
     if most_of_one_rank == 1:
-        higher_kicker_rank_range = [rank for rank in rank_range() if rank_tallies[rank] == 0]
+        higher_kicker_rank_range = [rank for rank in rank_range() if tally_of(rank_tallies, rank) == 0]
         for higher_kicker_rank in higher_kicker_rank_range:
             lower_kicker_rank_range = [rank for rank in higher_kicker_rank_range if rank < higher_kicker_rank]
             for lower_kicker_rank in lower_kicker_rank_range:
-                levels.append([Couplet(Card(higher_kicker_rank, anything), Card(lower_kicker_rank, anything))])
+                levels.append([(higher_kicker_rank, anything, lower_kicker_rank, anything)])
     return levels
 
 
+# The categories able to yield levels on a board whose most common rank appears once, twice, or three or more times, in
+# descending order of hand strength; every other category would yield no levels on such a board, so is skipped
+category_functions_by_max_tally = [None, \
+                                   [straight_flush_levels, flush_levels, straight_levels, three_of_a_kind_levels, \
+                                    two_pair_levels, one_pair_levels, high_card_levels], \
+                                   [straight_flush_levels, four_of_a_kind_levels, full_house_levels, flush_levels, \
+                                    straight_levels, three_of_a_kind_levels, two_pair_levels, one_pair_levels], \
+                                   [straight_flush_levels, four_of_a_kind_levels, full_house_levels, flush_levels, \
+                                    straight_levels, three_of_a_kind_levels]]
+
+
 def print_levels(levels):
     for level in levels:
         level_string = ""
         for couplet in level:
-            level_string += couplet.str() + "   "
+            level_string += couplet_to_str(couplet) + "   "
         print(level_string)
 
 
@@ -433,84 +501,141 @@ def remove_empty_levels(levels):
 
 
 # Explicitly list out all couplets belonging to each level, resolving all uses of the "anything" keyword
-def specify(generic_levels, board):
-    deck = [card for card in assemble_deck() if card.is_compatible(board)]
-    specific_couplets = [couplify(subset) for subset in subsets_of_size(2, deck)]
+def specify(generic_levels, board_bb):
+    generic_table = compile_generic_levels(generic_levels)
     specific_levels = [[] for level in generic_levels]
-    for specific_couplet in specific_couplets:
-        continue_scan = True
-        for level_index in range(len(generic_levels)):
-            generic_level = generic_levels[level_index]
-            for generic_couplet in generic_level:
-                if continue_scan and specific_couplet.fulfills(generic_couplet):
-                    specific_levels[level_index].append(specific_couplet)
-                    continue_scan = False
+    for card_bit_1, card_bit_2 in card_pair_bits:
+        if (card_bit_1 | card_bit_2) & board_bb:
+            continue
+        for level_index, cards_bb_1, cards_bb_2 in generic_table: # stop at the first (i.e. best) level the couplet fulfills
+            if (card_bit_1 & cards_bb_1 and card_bit_2 & cards_bb_2) or (card_bit_1 & cards_bb_2 and card_bit_2 & cards_bb_1):
+                specific_levels[level_index].append(card_bit_1 | card_bit_2)
+                break
     return remove_empty_levels(specific_levels)
 
 
+# Map each specific couplet to the index of the level containing it, so that finding a couplet's level takes one lookup
+def index_levels(levels):
+    return {couplet: level_index for level_index in range(len(levels)) for couplet in levels[level_index]}
+
+
+# Everything about a board that utility needs, independent of the holding: the level index of each specific couplet, the
+# number of couplets in each level, and for each card the sorted level indices of the couplets containing it
+BoardContext = namedtuple('BoardContext', 'couplet_to_level level_sizes card_levels')
+
+
+# Precompute the context of the board whose bitboard is given, so that any number of holdings can be evaluated against it
+# by passing the context to utility_with_context
+def precompute_board(board_bb):
+    board = [card for card in assemble_deck() if not is_compatible(card, board_bb)]
+    levels = specify(all_levels(board), board_bb)
+    card_levels = [[] for card in assemble_deck()]
+    for level_index in range(len(levels)):
+        for couplet in levels[level_index]:
+            card_levels[(couplet & -couplet).bit_length() - 1].append(level_index) # lowest set bit is the first card
+            card_levels[couplet.bit_length() - 1].append(level_index) # highest set bit is the second card
+    return BoardContext(index_levels(levels), [len(level) for level in levels], card_levels) # levels ascend, so card_levels come out sorted
+
+
 # Compute what fraction of the pot a player with the given holding can expect to win on the given board on average
 def utility(holding, board):
-    levels = specify(all_levels(board), board)
-    best_level_index = len(levels) # dummy initial value
-    for couplet in [couplify(subset) for subset in subsets_of_size(2, holding)]:
-        level_index = index_of_level_containing(couplet, levels)
-        if level_index < best_level_index: # the earlier a couplet appears in the level list, the better it is
-            best_level_index = level_index
-    num_better_couplets = len(remove_incompatible_couplets(flatten(levels[:best_level_index]), holding))
-    num_equipotent_couplets = len(remove_incompatible_couplets(levels[best_level_index], holding))
-    num_worse_couplets = len(remove_incompatible_couplets(flatten(levels[best_level_index + 1:]), holding))
-    prob_best_hand = comb(num_equipotent_couplets + num_worse_couplets, num_opponents_couplets) / \
-                     comb(num_better_couplets + num_equipotent_couplets + num_worse_couplets, num_opponents_couplets) \
-        # probability that none of the opponents' couplets form a better hand, assuming random distribution of couplets
-    expected_pot_fraction_given_best_hand = 0
-    try:
-        for num_equipotent_opponents_couplets in range(min(num_equipotent_couplets + 1, num_opponents_couplets + 1)):
-            num_worse_opponents_couplets = num_opponents_couplets - num_equipotent_opponents_couplets
-            prob_num_equipotent_opponents_couplets = comb(num_equipotent_couplets, num_equipotent_opponents_couplets) * \
-                                                     comb(num_worse_couplets, num_worse_opponents_couplets) / \
-                                                     comb(num_equipotent_couplets + num_worse_couplets, num_opponents_couplets) \
-                # probability that exactly [num] opponent couplets tie with you for the best hand
-            num_winners = num_equipotent_opponents_couplets + 1
-            expected_pot_fraction_given_best_hand += prob_num_equipotent_opponents_couplets / num_winners
-    except ZeroDivisionError: # this error occurs whenever there exist fewer equipotent-or-worse couplets than opponents' couplets
-        pass # leave expected pot fraction at 0 (its initial value), thereby allowing the return value to be 0
-    return prob_best_hand * expected_pot_fraction_given_best_hand
-
-
-'''test_board = deal_random_cards(board_size, assemble_deck())
+    return utility_with_context(holding, precompute_board(bitboard(board)))
+
+
+def utility_with_context(holding, board_context):
+    couplet_to_level, level_sizes, card_levels = board_context
+    holding_couplet_levels = [couplet_to_level[card_bits[holding[index_1]] | card_bits[holding[index_2]]] \
+                              for index_1, index_2 in holding_pair_indices]
+    best_level_index = min(holding_couplet_levels) # the earlier a couplet appears in the level list, the better it is
+    num_better_couplets = sum(level_sizes[:best_level_index])
+    num_equipotent_couplets = level_sizes[best_level_index]
+    num_worse_couplets = sum(level_sizes[best_level_index + 1:])
+    for card in holding: # couplets sharing a card with the holding cannot belong to an opponent, so discount them
+        levels_of_card = card_levels[card]
+        num_better_of_card = bisect_left(levels_of_card, best_level_index)
+        num_better_or_equipotent_of_card = bisect_right(levels_of_card, best_level_index)
+        num_better_couplets -= num_better_of_card
+        num_equipotent_couplets -= num_better_or_equipotent_of_card - num_better_of_card
+        num_worse_couplets -= len(levels_of_card) - num_better_or_equipotent_of_card
+    for level_index in holding_couplet_levels: # couplets of two holding cards were discounted once per card, so add one back
+        if level_index < best_level_index:
+            num_better_couplets += 1
+        elif level_index == best_level_index:
+            num_equipotent_couplets += 1
+        else:
+            num_worse_couplets += 1
+    # Assuming a random distribution of couplets, the expected pot fraction is the sum, over every number k of opponents'
+    # couplets tying with you while none beat you, of comb(E, k) * comb(W, N - k) / comb(B + E + W, N) ways for that to
+    # happen times the 1 / (k + 1) share of the pot it leaves you (with B, E, W the numbers of better, equipotent and worse
+    # couplets and N the number of opponents' couplets). As comb(E, k) / (k + 1) == comb(E + 1, k + 1) / (E + 1),
+    # Vandermonde's identity sums this to (comb(E + W + 1, N + 1) - comb(W, N + 1)) / ((E + 1) * comb(B + E + W, N)),
+    # which is also 0 whenever there exist fewer equipotent-or-worse couplets than opponents' couplets
+    num_weighted_ways_to_share_pot = comb_table[num_equipotent_couplets + num_worse_couplets + 1][num_opponents_couplets + 1] - \
+                                     comb_table[num_worse_couplets][num_opponents_couplets + 1]
+    num_ways_to_deal_opponents = comb_table[num_better_couplets + num_equipotent_couplets + num_worse_couplets][num_opponents_couplets]
+    return num_weighted_ways_to_share_pot / ((num_equipotent_couplets + 1) * num_ways_to_deal_opponents)
+
+
+'''rng = Random()
+test_board = deal_random_cards(board_size, assemble_deck(), rng)
 print_cards(test_board, "Board: ")
 print("")
 generic_levels = all_levels(test_board)
 #print_levels(generic_levels)
 print("")
-specific_levels = specify(generic_levels, test_board)
+specific_levels = specify(generic_levels, bitboard(test_board))
 print_levels(specific_levels)
 print("")
+board_context = precompute_board(bitboard(test_board))
+board_compatible_deck = [card for card in assemble_deck() if is_compatible(card, bitboard(test_board))]
 u = 0
 while u < 1:
-    test_holding = deal_random_cards(holding_size, [card for card in assemble_deck() if card.is_compatible(test_board)])
-    u = utility(test_holding, test_board)
+    test_holding = deal_random_cards(holding_size, board_compatible_deck, rng)
+    u = utility_with_context(test_holding, board_context)
 print_cards(test_holding, "Holding: ")
 print("Utility: " + str(u))'''
 
 
-num_trials = 25000
-test_holding = [Card(ace, hearts), \
-                Card(king, clubs), \
-                Card(queen, clubs), \
-                Card(ten, hearts)]
-print_cards(test_holding, "Holding: ")
-print("")
-sum_utilities = 0
-for trial_index in range(num_trials):
-    test_board = deal_random_cards(board_size, [card for card in assemble_deck() if card.is_compatible(test_holding)])
-    test_utility = utility(test_holding, test_board)
-    sum_utilities += test_utility
-    print_cards(test_board, "Trial " + str(trial_index + 1) + ": Utility is " + str(test_utility) + " on board ")
-print("")
-avg_utility = sum_utilities / num_trials
-print_cards(test_holding, "Holding: ")
-print("Average utility over " + str(num_trials) + " trials is " + str(avg_utility))
+# Deal a random board from the cards not in the holding, using a generator seeded for this trial alone, and evaluate the
+# holding on it
+def run_trial(holding, holding_compatible_deck, seed):
+    board = deal_random_cards(board_size, holding_compatible_deck, Random(seed))
+    return board, utility(holding, board)
+
+
+# Spread independent trials across processes, yielding each board along with the holding's utility on it in trial order;
+# every trial draws its seed from root_seed, so a given root_seed reproduces the same trials however they are scheduled
+def run_trials(holding, num_trials, root_seed=None):
+    seeder = Random(root_seed)
+    seeds = (seeder.getrandbits(64) for trial_index in range(num_trials)) # drawn as the pool hands out trials, in trial order
+    holding_bb = bitboard(holding)
+    holding_compatible_deck = [card for card in assemble_deck() if is_compatible(card, holding_bb)] # the same for every trial
+    with Pool(num_processes) as pool:
+        yield from pool.imap(partial(run_trial, holding, holding_compatible_deck), seeds, chunksize=trials_per_task)
+
+
+if __name__ == "__main__":
+    num_trials = 25000
+    test_holding = [make_card(ace, hearts), \
+                    make_card(king, clubs), \
+                    make_card(queen, clubs), \
+                    make_card(ten, hearts)]
+    print_cards(test_holding, "Holding: ")
+    print("")
+    sum_utilities = 0
+    trial_lines = []
+    for trial_index, (test_board, test_utility) in enumerate(run_trials(test_holding, num_trials)):
+        sum_utilities += test_utility
+        trial_lines.append(cards_to_str(test_board, "Trial " + str(trial_index + 1) + ": Utility is " + str(test_utility) + " on board "))
+        if len(trial_lines) >= trial_lines_per_write:
+            write_lines(trial_lines)
+            trial_lines.clear()
+    if trial_lines:
+        write_lines(trial_lines)
+    print("")
+    avg_utility = sum_utilities / num_trials
+    print_cards(test_holding, "Holding: ")
+    print("Average utility over " + str(num_trials) + " trials is " + str(avg_utility))
 
 
 # to-do: make 4oak function independent of num_suits; make 5oak function; short deck
\ No newline at end of file